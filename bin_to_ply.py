@@ -1,41 +1,291 @@
 import os
+import glob
 import numpy as np
-import open3d as o3d
+
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+
+    from numba import njit
+
+    NUMBA_AVAILABLE = True
+
+except ImportError as e:
+
+    if __name__ == '__main__':
+        print(f'{e} => numba kernel 사용 불가, numpy로 처리')
+
+    NUMBA_AVAILABLE = False
 
 # 입력 및 출력 경로
 bin_dir = "/home/soeun/LiDAR_snow_sim/nuScenes_intensity"
 ply_output_dir = "/home/soeun/LiDAR_snow_sim/output_ply"
 label_output_dir = "/home/soeun/LiDAR_snow_sim/output_label"
 
-os.makedirs(ply_output_dir, exist_ok=True)
-os.makedirs(label_output_dir, exist_ok=True)
+# 파일마다 os.path.join을 부르지 않도록 출력 경로 prefix를 미리 계산
+ply_prefix = ply_output_dir + os.sep
+label_prefix = label_output_dir + os.sep
 
-# 모든 .bin 파일 처리
-for filename in os.listdir(bin_dir):
-    if filename.endswith(".bin"):
-        bin_path = os.path.join(bin_dir, filename)
-        base_name = os.path.splitext(filename)[0]
+# 0이면 .bin 파일마다 .ply/.label 생성
+# >0이면 SHARD_SIZE개(예: 64) scan을 scan_id 열이 있는 하나의 shard .ply/.label로 묶음
+SHARD_SIZE = 0
 
-        # .bin 파일 읽기
-        points = np.fromfile(bin_path, dtype=np.float32).reshape(-1, 5)
-        xyz = points[:, :3]
-        intensity = points[:, 3]
-        labels = points[:, 4].astype(np.uint32)
+# binary PLY vertex 레이아웃 (xyz float32 + grayscale RGB uchar)
+PLY_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+                      ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+PLY_SHARD_DTYPE = np.dtype(PLY_DTYPE.descr + [('scan_id', '<u4')])
 
-        # ----------- PLY 파일 생성 -----------
-        pcd = o3d.geometry.PointCloud()
-        pcd.points = o3d.utility.Vector3dVector(xyz)
 
-        # intensity를 grayscale RGB로 매핑
-        intensity_norm = (intensity - intensity.min()) / (intensity.ptp() + 1e-5)
-        colors = np.stack([intensity_norm] * 3, axis=1)
-        pcd.colors = o3d.utility.Vector3dVector(colors)
+def ply_header(n, with_scan_id=False):
+    """vertex n개짜리 little-endian binary PLY header"""
+    header = ("ply\n"
+              "format binary_little_endian 1.0\n"
+              f"element vertex {n}\n"
+              "property float x\n"
+              "property float y\n"
+              "property float z\n"
+              "property uchar red\n"
+              "property uchar green\n"
+              "property uchar blue\n")
+    if with_scan_id:
+        header += "property uint scan_id\n"
+    header += "end_header\n"
+
+    return header.encode('ascii')
+
+
+def to_records(xyz, gray, scan_id=None):
+    """xyz와 grayscale 값을 PLY vertex structured array로 변환"""
+    rec = np.empty(len(xyz), dtype=PLY_DTYPE if scan_id is None else PLY_SHARD_DTYPE)
+    rec['x'] = xyz[:, 0]
+    rec['y'] = xyz[:, 1]
+    rec['z'] = xyz[:, 2]
+    rec['red'] = rec['green'] = rec['blue'] = gray
+    if scan_id is not None:
+        rec['scan_id'] = scan_id
+
+    return rec
+
+
+def write_ply(ply_path, xyz, gray):
+    """xyz와 grayscale 값을 little-endian binary PLY로 저장 (Open3D 없이)"""
+    with open(ply_path, 'wb') as f:
+        f.write(ply_header(len(xyz)))
+        to_records(xyz, gray).tofile(f)
+
+
+def intensity_bins(intensity, bins=256):
+    """
+    intensity를 [min, max] 구간을 bins개로 균등 분할한 bin index로 변환
+    (numba kernel bin_intensity()와 같은 float64 식을 사용하므로 결과가 동일)
+    """
+    imin = np.float64(intensity.min())
+    imax = np.float64(intensity.max())
+    scale = bins / (imax - imin) if imax > imin else 0.0
+
+    idx = ((intensity.astype(np.float64) - imin) * scale).astype(np.int64)
+
+    return np.minimum(idx, bins - 1)
+
+
+def equalization_lut(h, n):
+    """히스토그램 h의 누적 분포(CDF)로 0~255 uint8 lookup table 생성"""
+    C = np.cumsum(h)
+    Cmin = C[C > 0][0]
+
+    lut = np.round((C - Cmin) / max(n - Cmin, 1) * 255)
+
+    return np.clip(lut, 0, 255).astype(np.uint8)
+
+
+if NUMBA_AVAILABLE:
+
+    @njit(cache=True)
+    def bin_intensity(intensity, bins, out_idx):
+        """
+        intensity_bins() + 히스토그램을 하나의 kernel로 처리
+        (min/max reduction -> bin index를 out_idx에 기록 -> bin별 개수 반환)
+
+        bin_to_ply.py는 파일 단위로 ProcessPoolExecutor에서 병렬 처리하므로
+        kernel 내부는 prange 없이 직렬로 둠 (thread oversubscription 방지)
+        """
+        n = intensity.shape[0]
+
+        imin = np.float64(intensity[0])
+        imax = imin
+        for i in range(n):
+            v = np.float64(intensity[i])
+            if v < imin:
+                imin = v
+            if v > imax:
+                imax = v
+
+        scale = bins / (imax - imin) if imax > imin else 0.0
+
+        h = np.zeros(bins, dtype=np.int64)
+        for i in range(n):
+            b = min(int((np.float64(intensity[i]) - imin) * scale), bins - 1)
+            out_idx[i] = b
+            h[b] += 1
+
+        return h
+
+
+def equalize_intensity(intensity, bins=256):
+    """
+    intensity를 histogram equalization으로 0~255 uint8 grayscale로 변환
+
+    LiDAR intensity는 0 근처에 몰린 heavy-tailed 분포라서 min-max 정규화보다
+    누적 히스토그램(CDF) 기반 lookup table이 dynamic range를 더 잘 활용함
+    numba가 있으면 bin 계산과 히스토그램을 kernel 한 번으로 처리 (결과는 동일)
+    """
+    n = len(intensity)
+
+    # NaN/inf는 bin index가 범위를 벗어나므로 두 경로 모두 실행 전에 거부
+    # (numba kernel은 bounds check를 하지 않아 out-of-bounds write가 됨)
+    finite = np.isfinite(intensity)
+    if not finite.all():
+        raise ValueError(f"intensity에 NaN/inf 값이 {n - np.count_nonzero(finite)}개 있습니다")
 
-        ply_path = os.path.join(ply_output_dir, f"{base_name}.ply")
-        o3d.io.write_point_cloud(ply_path, pcd)
+    if NUMBA_AVAILABLE:
+        idx = np.empty(n, dtype=np.int64)
+        h = bin_intensity(np.asarray(intensity), bins, idx)
+    else:
+        idx = intensity_bins(intensity, bins)
+        h = np.bincount(idx, minlength=bins)
+
+    return equalization_lut(h, n)[idx]
+
+
+def convert_scan(bin_path):
+    """.bin 파일 하나를 읽어 (xyz, gray, labels)로 변환"""
+    filename = os.path.basename(bin_path)
+
+    # .bin 파일 읽기 (읽기 전용 memmap, points는 수정하지 말 것)
+    points = np.memmap(bin_path, dtype=np.float32, mode='r').reshape(-1, 5)
+
+    # nuScenes label ID는 uint16 범위면 충분 (uint32 대비 .label 크기 1/2)
+    # 주의: .label 파일 형식이 uint32 -> uint16으로 바뀌었으므로
+    #       읽는 쪽에서도 np.fromfile(label_path, dtype=np.uint16)을 사용해야 함
+    labels = points[:, 4]
+    if labels.min() < 0 or labels.max() > 65535:
+        raise ValueError(f"{filename}: label ID가 uint16 범위(0~65535)를 벗어납니다 "
+                         f"({labels.min()} ~ {labels.max()})")
+    labels = labels.astype(np.uint16)
+
+    # xyz는 memmap view 그대로 두고 to_records()에서 한 번만 복사
+    xyz = points[:, :3]
+
+    # intensity를 histogram equalization으로 grayscale (0~255)로 매핑
+    gray = equalize_intensity(points[:, 3])
+
+    return xyz, gray, labels
+
+
+def is_up_to_date(bin_path):
+    """
+    .ply와 .label이 모두 .bin보다 최신이고 크기도 맞으면 이미 처리된 파일로 간주
+    크기 검사로 예전 uint32 형식 .label이나 잘린 파일은 다시 변환함
+    """
+    base_name = os.path.basename(bin_path)[:-4]
+    ply_path = f"{ply_prefix}{base_name}.ply"
+    label_path = f"{label_prefix}{base_name}.label"
+
+    if not (os.path.exists(ply_path) and os.path.exists(label_path)):
+        return False
+
+    bin_mtime = os.path.getmtime(bin_path)
+    if os.path.getmtime(ply_path) < bin_mtime or os.path.getmtime(label_path) < bin_mtime:
+        return False
+
+    # point당 .bin은 float32 5개, .label은 uint16 1개, .ply는 header + PLY_DTYPE 1개
+    n = os.path.getsize(bin_path) // 20
+
+    return (os.path.getsize(label_path) == n * 2
+            and os.path.getsize(ply_path) == len(ply_header(n)) + n * PLY_DTYPE.itemsize)
+
+
+def process_one(bin_path):
+    """.bin 파일 하나를 .ply + .label 파일로 변환"""
+    filename = os.path.basename(bin_path)
+    base_name = filename[:-4]  # ".bin" 제거
+
+    xyz, gray, labels = convert_scan(bin_path)
+
+    ply_path = f"{ply_prefix}{base_name}.ply"
+    label_path = f"{label_prefix}{base_name}.label"
+
+    # 중간에 죽어도 잘린 파일이 최신 결과로 남지 않도록 .tmp에 먼저 씀
+    try:
+        # ----------- PLY 파일 생성 -----------
+        write_ply(ply_path + '.tmp', xyz, gray)
 
         # ----------- LABEL 파일 생성 -----------
-        label_path = os.path.join(label_output_dir, f"{base_name}.label")
-        labels.tofile(label_path)
+        labels.tofile(label_path + '.tmp')
+    except Exception:
+        for tmp_path in (ply_path + '.tmp', label_path + '.tmp'):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+
+    # .label을 마지막에 교체하여 완료 표시로 사용
+    os.replace(ply_path + '.tmp', ply_path)
+    os.replace(label_path + '.tmp', label_path)
+
+    print(f"Processed {filename} -> {base_name}.ply + {base_name}.label")
+
+
+def process_shard(shard_idx, bin_paths):
+    """
+    .bin 파일 여러 개를 하나의 shard .ply + .label 파일로 변환
+    vertex의 scan_id는 shard_XXXXX.txt에 기록된 파일 순서의 index
+    """
+    shard_name = f"shard_{shard_idx:05d}"
+
+    # header에 쓸 전체 vertex 수는 파일 크기로 미리 계산 (point당 float32 5개)
+    n_total = sum(os.path.getsize(bin_path) // 20 for bin_path in bin_paths)
+
+    ply_path = f"{ply_prefix}{shard_name}.ply"
+    label_path = f"{label_prefix}{shard_name}.label"
+
+    # header의 vertex 수와 실제 body가 어긋난 shard가 남지 않도록
+    # .tmp에 먼저 쓰고 모든 scan을 다 쓴 뒤에만 os.replace로 교체
+    try:
+        with open(ply_path + '.tmp', 'wb') as f_ply, open(label_path + '.tmp', 'wb') as f_label:
+            f_ply.write(ply_header(n_total, with_scan_id=True))
+
+            for scan_id, bin_path in enumerate(bin_paths):
+                xyz, gray, labels = convert_scan(bin_path)
+                to_records(xyz, gray, scan_id).tofile(f_ply)
+                labels.tofile(f_label)
+    except Exception:
+        for tmp_path in (ply_path + '.tmp', label_path + '.tmp'):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+
+    os.replace(ply_path + '.tmp', ply_path)
+    os.replace(label_path + '.tmp', label_path)
+
+    with open(f"{ply_prefix}{shard_name}.txt", 'w') as f:
+        f.write("\n".join(os.path.basename(bin_path) for bin_path in bin_paths) + "\n")
+
+    print(f"Processed {len(bin_paths)} files -> {shard_name}.ply + {shard_name}.label")
+
+
+if __name__ == "__main__":
+    os.makedirs(ply_output_dir, exist_ok=True)
+    os.makedirs(label_output_dir, exist_ok=True)
+
+    # 모든 .bin 파일을 CPU 코어 수만큼 병렬 처리
+    paths = sorted(glob.glob(os.path.join(bin_dir, "*.bin")))
 
-        print(f"Processed {filename} -> {base_name}.ply + {base_name}.label")
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+        if SHARD_SIZE > 0:
+            shards = [paths[i:i + SHARD_SIZE] for i in range(0, len(paths), SHARD_SIZE)]
+            list(ex.map(process_shard, range(len(shards)), shards))
+        else:
+            # 이미 처리된 파일은 건너뛰어 재실행 시 바뀐 파일만 변환
+            todo = [path for path in paths if not is_up_to_date(path)]
+            print(f"{len(paths) - len(todo)}/{len(paths)} files up to date, skipping")
+            list(ex.map(process_one, todo, chunksize=16))
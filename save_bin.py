@@ -2,6 +2,8 @@ import numpy as np
 import open3d as o3d
 
 bin_path = '/home/soeun/LiDAR_snow_sim/simulated_snowflake_output.bin'
-points = np.fromfile(bin_path, dtype=np.float32).reshape(-1, 5)
+# 읽기 전용 memmap (points는 수정하지 말 것)
+points = np.memmap(bin_path, dtype=np.float32, mode='r').reshape(-1, 5)
 
-points.astype(np.float32).tofile('/home/soeun/LiDAR_snow_sim/nuScenes_soeun/nuScenes_intensity/001401.bin')
\ No newline at end of file
+# 이미 float32이므로 astype 복사 없이 그대로 저장
+points.tofile('/home/soeun/LiDAR_snow_sim/nuScenes_soeun/nuScenes_intensity/001401.bin')
\ No newline at end of file
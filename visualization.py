@@ -3,88 +3,186 @@ import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 import open3d as o3d
 from matplotlib.colors import ListedColormap
+from matplotlib.lines import Line2D
 
-def visualize_bin_file_with_labels(bin_path, method='matplotlib', point_size=1):
+try:
+
+    from vispy import app, scene
+    from vispy import io as vispy_io
+
+    VISPY_AVAILABLE = True
+
+except ImportError as e:
+
+    if __name__ == '__main__':
+        print(f'{e} => vispy 시각화 사용 불가')
+
+    VISPY_AVAILABLE = False
+
+def load_bin(bin_path):
     """
-    bin 파일을 로드하여 label에 따라 다른 색깔로 시각화
+    bin 파일을 한 번만 로드하여 (xyz, intensity, labels)로 분리
     
     Args:
         bin_path: .bin 파일 경로
-        method: 'matplotlib' 또는 'open3d'
-        point_size: 포인트 크기
+    Returns:
+        xyz, intensity, labels
+        (xyz, intensity는 읽기 전용 memmap view이므로 수정하지 말 것)
     """
-    # bin 파일 로드 (x, y, z, intensity, label 순서)
-    points = np.fromfile(bin_path, dtype=np.float32).reshape(-1, 5)
+    # bin 파일을 memmap으로 로드 (x, y, z, intensity, label 순서)
+    # 실제로 접근하는 열만 OS가 필요할 때 page-in 함
+    points = np.memmap(bin_path, dtype=np.float32, mode='r').reshape(-1, 5)
     
     # 좌표와 label 분리
     xyz = points[:, :3]  # x, y, z
     intensity = points[:, 3]  # intensity
-    labels = points[:, 4].astype(int)  # label
+    labels = points[:, 4].astype(np.int32)  # label (작은 배열이므로 복사본으로 보관)
+    
+    return xyz, intensity, labels
+
+# 화면 표시가 불가능한 matplotlib backend (파일 출력 전용)
+NON_INTERACTIVE_BACKENDS = ('agg', 'cairo', 'pdf', 'pgf', 'ps', 'svg', 'template')
+
+def finish_figure(fig, save_path=None):
+    """
+    save_path가 있으면 저장, 없으면 화면에 표시한 뒤 figure를 닫아 메모리 해제
+    (Agg, pdf 같은 non-interactive backend에서는 plt.show()를 건너뜀)
+    """
+    if save_path is not None:
+        fig.savefig(save_path)
+    elif plt.get_backend().lower() not in NON_INTERACTIVE_BACKENDS:
+        plt.show()
+    
+    plt.close(fig)
+
+def visualize_bin_file_with_labels(data, method='matplotlib', point_size=1, max_points=20000, save_path=None):
+    """
+    로드된 포인트를 label에 따라 다른 색깔로 시각화
     
-    print(f"포인트 수: {len(points)}")
+    Args:
+        data: load_bin()이 반환한 (xyz, intensity, labels)
+        method: 'matplotlib', 'open3d' 또는 'vispy'
+        point_size: 포인트 크기
+        max_points: matplotlib scatter에 그릴 최대 포인트 수 (None이면 전체)
+        save_path: 지정하면 창을 띄우지 않고 이미지로 저장 (반복 호출 시 메모리 누수 방지)
+    """
+    xyz, intensity, labels = data
+    
+    print(f"포인트 수: {len(xyz)}")
     print(f"좌표 범위: X({xyz[:, 0].min():.2f} ~ {xyz[:, 0].max():.2f}), "
           f"Y({xyz[:, 1].min():.2f} ~ {xyz[:, 1].max():.2f}), "
           f"Z({xyz[:, 2].min():.2f} ~ {xyz[:, 2].max():.2f})")
     print(f"라벨 종류: {np.unique(labels)}")
     
     if method == 'matplotlib':
-        visualize_with_matplotlib(xyz, labels, intensity, point_size)
+        visualize_with_matplotlib(xyz, labels, intensity, point_size, max_points=max_points,
+                                  save_path=save_path)
     elif method == 'open3d':
-        visualize_with_open3d(xyz, labels, intensity)
+        visualize_with_open3d(xyz, labels, intensity, save_path=save_path)
+    elif method == 'vispy':
+        visualize_with_vispy(xyz, labels, intensity, point_size, save_path=save_path)
     else:
-        print("지원하지 않는 방법입니다. 'matplotlib' 또는 'open3d'를 사용하세요.")
+        print("지원하지 않는 방법입니다. 'matplotlib', 'open3d' 또는 'vispy'를 사용하세요.")
+
+def subsample_by_label(label_idx, max_points, seed=0):
+    """
+    라벨별로 층화하여 최대 max_points개의 포인트 index를 무작위 샘플링
+    (드문 라벨은 모두 남기고, 남는 몫을 큰 라벨들에 나눠줌)
+    라벨 수가 max_points보다 많으면 라벨당 1개씩이라 max_points를 넘을 수 있음
+    """
+    counts = np.bincount(label_idx)
+    
+    # 라벨당 최대 개수(cap) 결정: 작은 라벨부터 채우고 남은 몫을 균등 분배
+    cap = counts.max()
+    remaining = max_points
+    sorted_counts = np.sort(counts)
+    for i, count in enumerate(sorted_counts):
+        share = remaining // (len(counts) - i)
+        if count > share:
+            # 라벨 수가 max_points보다 많아도 라벨당 최소 1개는 남김
+            cap = max(share, 1)
+            break
+        remaining -= count
+    
+    # 무작위로 섞은 뒤 라벨 순으로 stable 정렬 → 라벨별 순위가 cap 미만인 것만 선택
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(label_idx))
+    order = order[np.argsort(label_idx[order], kind='stable')]
+    starts = np.cumsum(counts) - counts
+    rank = np.arange(len(order)) - np.repeat(starts, counts)
+    
+    return np.sort(order[rank < cap])
 
-def visualize_with_matplotlib(xyz, labels, intensity, point_size=1):
-    """matplotlib를 사용한 시각화"""
+def visualize_with_matplotlib(xyz, labels, intensity, point_size=1, max_points=20000, save_path=None):
+    """
+    matplotlib를 사용한 시각화
+    
+    scatter는 max_points개까지만 라벨별로 층화 샘플링하여 그림 (None이면 전체)
+    intensity 분포는 항상 전체 포인트로 계산
+    """
     fig = plt.figure(figsize=(15, 12))
     
-    # 고유한 라벨들
-    unique_labels = np.unique(labels)
+    # 고유한 라벨들과 각 포인트의 라벨 인덱스 (정렬 한 번으로 계산)
+    unique_labels, label_idx = np.unique(labels, return_inverse=True)
     colors = plt.cm.tab20(np.linspace(0, 1, len(unique_labels)))
     
+    # 3D scatter 인터랙티브 유지를 위한 샘플링
+    if max_points is not None and len(xyz) > max_points:
+        sample = subsample_by_label(label_idx, max_points)
+        print(f"scatter 표시 포인트: {len(sample)} / {len(xyz)}")
+    else:
+        sample = slice(None)
+    
+    # 라벨 인덱스 → RGBA 색상 (scatter 한 번에 그리기 위함)
+    rgba = colors[label_idx[sample]]
+    sample_xyz = xyz[sample]
+    
+    # 범례는 라벨별 proxy artist로 따로 구성
+    legend_handles = [Line2D([0], [0], marker='o', linestyle='', color=colors[i],
+                             label=f'Label {label}')
+                      for i, label in enumerate(unique_labels)]
+    
     # 3D 시각화
     ax1 = fig.add_subplot(221, projection='3d')
-    for i, label in enumerate(unique_labels):
-        mask = labels == label
-        ax1.scatter(xyz[mask, 0], xyz[mask, 1], xyz[mask, 2], 
-                   c=[colors[i]], label=f'Label {label}', s=point_size)
+    ax1.scatter(sample_xyz[:, 0], sample_xyz[:, 1], sample_xyz[:, 2], c=rgba, s=point_size)
     
     ax1.set_xlabel('X')
     ax1.set_ylabel('Y')
     ax1.set_zlabel('Z')
     ax1.set_title('3D Point Cloud by Labels')
-    ax1.legend(bbox_to_anchor=(1.05, 1), loc='upper left')
+    ax1.legend(handles=legend_handles, bbox_to_anchor=(1.05, 1), loc='upper left')
     
     # 2D Top View (X-Y)
     ax2 = fig.add_subplot(222)
-    for i, label in enumerate(unique_labels):
-        mask = labels == label
-        ax2.scatter(xyz[mask, 0], xyz[mask, 1], 
-                   c=[colors[i]], label=f'Label {label}', s=point_size)
+    ax2.scatter(sample_xyz[:, 0], sample_xyz[:, 1], c=rgba, s=point_size)
     
     ax2.set_xlabel('X')
     ax2.set_ylabel('Y')
     ax2.set_title('Top View (X-Y)')
     ax2.axis('equal')
-    ax2.legend(bbox_to_anchor=(1.05, 1), loc='upper left')
+    ax2.legend(handles=legend_handles, bbox_to_anchor=(1.05, 1), loc='upper left')
     
     # 2D Side View (X-Z)
     ax3 = fig.add_subplot(223)
-    for i, label in enumerate(unique_labels):
-        mask = labels == label
-        ax3.scatter(xyz[mask, 0], xyz[mask, 2], 
-                   c=[colors[i]], label=f'Label {label}', s=point_size)
+    ax3.scatter(sample_xyz[:, 0], sample_xyz[:, 2], c=rgba, s=point_size)
     
     ax3.set_xlabel('X')
     ax3.set_ylabel('Z')
     ax3.set_title('Side View (X-Z)')
-    ax3.legend(bbox_to_anchor=(1.05, 1), loc='upper left')
+    ax3.legend(handles=legend_handles, bbox_to_anchor=(1.05, 1), loc='upper left')
     
     # Intensity 분포
+    # 모든 라벨의 히스토그램을 histogram2d 한 번으로 계산 (열 = 라벨)
     ax4 = fig.add_subplot(224)
+    imin, imax = intensity.min(), intensity.max()
+    if imin == imax:
+        imin, imax = imin - 0.5, imax + 0.5
+    edges = np.linspace(imin, imax, 51)
+    H, _, _ = np.histogram2d(intensity, label_idx,
+                             bins=[edges, np.arange(len(unique_labels) + 1)])
+    widths = np.diff(edges)
     for i, label in enumerate(unique_labels):
-        mask = labels == label
-        ax4.hist(intensity[mask], bins=50, alpha=0.7, 
+        ax4.bar(edges[:-1], H[:, i], width=widths, align='edge', alpha=0.7,
                 label=f'Label {label}', color=colors[i])
     
     ax4.set_xlabel('Intensity')
@@ -93,26 +191,35 @@ def visualize_with_matplotlib(xyz, labels, intensity, point_size=1):
     ax4.legend()
     
     plt.tight_layout()
-    plt.show()
+    finish_figure(fig, save_path)
 
-def visualize_with_open3d(xyz, labels, intensity):
+def visualize_with_open3d(xyz, labels, intensity, save_path=None):
     """Open3D를 사용한 고급 시각화"""
     # Point cloud 생성
     pcd = o3d.geometry.PointCloud()
     pcd.points = o3d.utility.Vector3dVector(xyz)
     
     # 라벨에 따른 색상 지정
-    unique_labels = np.unique(labels)
+    unique_labels, label_idx = np.unique(labels, return_inverse=True)
     colors = plt.cm.tab20(np.linspace(0, 1, len(unique_labels)))
     
-    # 각 포인트에 색상 할당
-    point_colors = np.zeros((len(xyz), 3))
-    for i, label in enumerate(unique_labels):
-        mask = labels == label
-        point_colors[mask] = colors[i][:3]  # RGB만 사용
+    # 각 포인트에 색상 할당 (라벨 인덱스로 한 번에 gather, RGB만 사용)
+    point_colors = colors[label_idx, :3].astype(np.float64, copy=False)
     
     pcd.colors = o3d.utility.Vector3dVector(point_colors)
     
+    # 이미지로 저장 후 창을 명시적으로 닫아 GLFW 창 누수 방지
+    if save_path is not None:
+        vis = o3d.visualization.Visualizer()
+        vis.create_window(window_name="LiDAR Point Cloud with Labels",
+                          width=1200, height=800, visible=False)
+        vis.add_geometry(pcd)
+        vis.poll_events()
+        vis.update_renderer()
+        vis.capture_screen_image(save_path)
+        vis.destroy_window()
+        return
+    
     # 시각화
     print("Open3D 창에서 시각화 중...")
     print("- 마우스로 회전/줌 가능")
@@ -122,12 +229,57 @@ def visualize_with_open3d(xyz, labels, intensity):
                                     window_name="LiDAR Point Cloud with Labels",
                                     width=1200, height=800)
 
-def analyze_labels(bin_path):
-    """라벨 분포 분석"""
-    points = np.fromfile(bin_path, dtype=np.float32).reshape(-1, 5)
-    labels = points[:, 4].astype(int)
+def visualize_with_vispy(xyz, labels, intensity, point_size=1, save_path=None):
+    """VisPy(GPU)를 사용한 대용량 포인트 클라우드 인터랙티브 시각화"""
+    if not VISPY_AVAILABLE:
+        print("vispy가 설치되어 있지 않습니다. 'matplotlib' 또는 'open3d'를 사용하세요.")
+        return
+    
+    # 라벨에 따른 색상 지정
+    unique_labels, label_idx = np.unique(labels, return_inverse=True)
+    colors = plt.cm.tab20(np.linspace(0, 1, len(unique_labels)))
+    rgba = colors[label_idx]
+    
+    canvas = scene.SceneCanvas(keys='interactive', title="LiDAR Point Cloud with Labels",
+                               size=(1200, 800), show=save_path is None)
+    view = canvas.central_widget.add_view()
+    view.camera = scene.cameras.TurntableCamera(fov=45)
+    
+    markers = scene.visuals.Markers()
+    markers.set_data(np.ascontiguousarray(xyz, dtype=np.float32), face_color=rgba,
+                     edge_width=0, size=point_size)
+    view.add(markers)
+    
+    # 이미지로 저장 후 canvas를 닫아 GPU 리소스 해제
+    if save_path is not None:
+        vispy_io.write_png(save_path, canvas.render())
+        canvas.close()
+        return
+    
+    print("VisPy 창에서 시각화 중...")
+    print("- 마우스로 회전/줌 가능")
+    print("- 창을 닫으면 종료")
+    
+    app.run()
+    canvas.close()
+
+def analyze_labels(data, save_path=None):
+    """
+    라벨 분포 분석
     
-    unique_labels, counts = np.unique(labels, return_counts=True)
+    Args:
+        data: load_bin()이 반환한 (xyz, intensity, labels)
+        save_path: 지정하면 막대 그래프를 이미지로 저장
+    """
+    _, _, labels = data
+    
+    # 라벨은 작은 음이 아닌 정수이므로 정렬 없이 bincount로 O(N)에 집계
+    if len(labels) > 0 and labels.min() >= 0:
+        counts = np.bincount(labels)
+        unique_labels = np.flatnonzero(counts)
+        counts = counts[unique_labels]
+    else:
+        unique_labels, counts = np.unique(labels, return_counts=True)
     
     print("\n=== 라벨 분석 ===")
     for label, count in zip(unique_labels, counts):
@@ -135,20 +287,18 @@ def analyze_labels(bin_path):
         print(f"Label {label}: {count:,}개 ({percentage:.2f}%)")
     
     # 라벨 분포 시각화
-    plt.figure(figsize=(10, 6))
+    fig = plt.figure(figsize=(10, 6))
     bars = plt.bar(unique_labels, counts, color=plt.cm.tab20(np.linspace(0, 1, len(unique_labels))))
     plt.xlabel('Label')
     plt.ylabel('Point Count')
     plt.title('Label Distribution')
     
     # 막대 위에 개수 표시
-    for bar, count in zip(bars, counts):
-        plt.text(bar.get_x() + bar.get_width()/2, bar.get_height() + max(counts)*0.01, 
-                f'{count:,}', ha='center', va='bottom')
+    plt.gca().bar_label(bars, labels=[f'{count:,}' for count in counts], padding=3)
     
     plt.grid(True, alpha=0.3)
     plt.tight_layout()
-    plt.show()
+    finish_figure(fig, save_path)
 
 # 사용 예시
 if __name__ == "__main__":
@@ -156,16 +306,19 @@ if __name__ == "__main__":
     bin_path = '/home/soeun/LiDAR_snow_sim/nuScenes_intensity/001000.bin'
     
     try:
+        # bin 파일은 한 번만 로드하여 재사용
+        data = load_bin(bin_path)
+        
         # 라벨 분석
-        analyze_labels(bin_path)
+        analyze_labels(data)
         
         # matplotlib로 시각화
         print("\n=== Matplotlib 시각화 ===")
-        visualize_bin_file_with_labels(bin_path, method='matplotlib', point_size=0.5)
+        visualize_bin_file_with_labels(data, method='matplotlib', point_size=0.5)
         
         # Open3D로 시각화 (더 좋은 3D 경험)
         print("\n=== Open3D 시각화 ===")
-        visualize_bin_file_with_labels(bin_path, method='open3d')
+        visualize_bin_file_with_labels(data, method='open3d')
         
     except FileNotFoundError:
         print(f"파일을 찾을 수 없습니다: {bin_path}")
@@ -173,25 +326,26 @@ if __name__ == "__main__":
         print(f"오류 발생: {e}")
 
 # 특정 라벨만 시각화하고 싶은 경우
-def visualize_specific_labels(bin_path, target_labels, method='matplotlib'):
-    """특정 라벨들만 시각화"""
-    points = np.fromfile(bin_path, dtype=np.float32).reshape(-1, 5)
+def visualize_specific_labels(data, target_labels, method='matplotlib', max_points=20000, save_path=None):
+    """특정 라벨들만 시각화 (data: load_bin()이 반환한 (xyz, intensity, labels))"""
+    xyz, intensity, labels = data
     
     # 특정 라벨들만 필터링
-    mask = np.isin(points[:, 4].astype(int), target_labels)
-    filtered_points = points[mask]
+    mask = np.isin(labels, target_labels)
     
-    if len(filtered_points) == 0:
+    if not mask.any():
         print(f"지정한 라벨 {target_labels}에 해당하는 포인트가 없습니다.")
         return
     
-    xyz = filtered_points[:, :3]
-    labels = filtered_points[:, 4].astype(int)
-    intensity = filtered_points[:, 3]
+    xyz = xyz[mask]
+    labels = labels[mask]
+    intensity = intensity[mask]
     
-    print(f"필터링된 포인트 수: {len(filtered_points)}")
+    print(f"필터링된 포인트 수: {len(xyz)}")
     
     if method == 'matplotlib':
-        visualize_with_matplotlib(xyz, labels, intensity)
+        visualize_with_matplotlib(xyz, labels, intensity, max_points=max_points, save_path=save_path)
     elif method == 'open3d':
-        visualize_with_open3d(xyz, labels, intensity)
\ No newline at end of file
+        visualize_with_open3d(xyz, labels, intensity, save_path=save_path)
+    elif method == 'vispy':
+        visualize_with_vispy(xyz, labels, intensity, save_path=save_path)
\ No newline at end of file